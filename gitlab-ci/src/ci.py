@@ -64,6 +64,13 @@ def sh(
         subprocess.run(cmdline, **kwargs).check_returncode()
 
 
+def sh_async(*popenargs, **kwargs) -> subprocess.Popen:
+    """Like `sh`, but return the running process instead of waiting for it to finish."""
+    cmdline = list(popenargs)
+    logging.info(f"$ {shlex.join(cmdline)} &")
+    return subprocess.Popen(cmdline, **kwargs)
+
+
 def mkdir_p(dir):
     logging.info(f"$ mkdir -p {dir}")
     pathlib.Path(dir).mkdir(parents=True, exist_ok=True)
@@ -1,19 +1,31 @@
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import shutil
+import subprocess
+from glob import glob
+from multiprocessing.pool import AsyncResult
 from os import environ
 from os import getenv
 from os import path
+from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Set
 
 from ci import cwd
 from ci import ENV
-from ci import flatten
 from ci import mkdir_p
 from ci import sh
+from ci import sh_async
 from ci import show_sccache_stats
 
-CANISTERS = [
+CANISTERS = (
     "cycles-minting-canister",
     "genesis-token-canister",
     "governance-canister",
@@ -39,20 +51,180 @@ CANISTERS = [
     "upgrade-test-canister",
     "wasm",
     "xnet-test-canister",
-]
+)
 
-CANISTER_COPY_LIST = {"cow_safety.wasm": "rs/tests/src", "counter.wat": "rs/workload_generator/src"}
+# Canisters built a second time with extra features, as `(bin, features)`. The result is named `<bin>_<features>.wasm`.
+FEATURE_BUILDS = (("ledger-canister", "notify-method"), ("governance-canister", "test"))
+
+CANISTER_COPY_LIST = (("cow_safety.wasm", "rs/tests/src"), ("counter.wat", "rs/workload_generator/src"))
 
 artifact_ext = getenv("ARTIFACT_EXT", "")
 default_artifacts_dir = f"{ENV.top}/artifacts/canisters{artifact_ext}"
+# Optimized canisters are stored here as `<hash>.wasm.gz`, keyed by everything that goes into building them.
+cache_dir = getenv("CANISTER_CACHE_DIR")
+# Put the Wasm produced by cargo into the artifacts as is, e.g. for quick local iterations.
+skip_optimize = getenv("SKIP_WASM_OPTIMIZE", "") != ""
+
+
+def _hash_tree(root: str) -> str:
+    """
+    Hash the files tracked by git under `root`, including uncommitted changes.
+
+    Untracked files, like the build script output in `gen/`, are left out, so the hash doesn't depend on what was built
+    in the checkout before.
+    """
+    h = hashlib.sha256()
+    # The blob hashes of the index cover the tracked and staged content. A failing git must not hash to the same
+    # empty listing for any sources, so the exit codes are checked.
+    h.update(sh("git", "ls-files", "-s", "--", ".", cwd=root, capture=True, check=True).encode("utf-8"))
+    for name in sh("git", "ls-files", "-m", "--", ".", cwd=root, capture=True, check=True).splitlines():
+        filename = path.join(root, name)
+        h.update(name.encode("utf-8"))
+        if path.isfile(filename):
+            with open(filename, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def _canister_hashes(bins) -> Dict[str, str]:
+    """
+    Hash the inputs of each of the given cargo binaries.
 
+    This covers the lock file, the workspace manifest, the compiler and the sources of every workspace crate in the
+    dependency closure of the binary. Crates from registries or git are pinned by the lock file. Must be run in `rs`.
 
-def _optimize_wasm(artifacts_dir, bin):
-    src_filename = f"{ENV.cargo_target_dir}/wasm32-unknown-unknown/release/{bin}.wasm"
-    if path.exists(src_filename):
-        sh("ic-cdk-optimizer", "-o", f"{artifacts_dir}/{bin}.wasm", src_filename)
+    The binaries must all be built by one cargo invocation, as cargo unifies the features of everything it builds.
+    """
+    metadata = json.loads(sh("cargo", "metadata", "--format-version", "1", capture=True, check=True))
+    packages = {p["id"]: p for p in metadata["packages"]}
+    dependencies = {n["id"]: n["dependencies"] for n in metadata["resolve"]["nodes"]}
+
+    common = hashlib.sha256()
+    for filename in ["Cargo.lock", "Cargo.toml"]:
+        with open(filename, "rb") as f:
+            common.update(f.read())
+    common.update(sh("rustc", "-vV", capture=True, check=True).encode("utf-8"))
+    common.update(getenv("RUSTFLAGS", "").encode("utf-8"))
+    # The other binaries built alongside can enable features of the shared dependencies.
+    common.update(" ".join(sorted(bins)).encode("utf-8"))
+    if skip_optimize:
+        common.update(b"unoptimized")
     else:
-        raise Exception(f"ERROR: target canister Wasm binary does not exist: {src_filename}")
+        common.update(sh("ic-cdk-optimizer", "--version", capture=True, check=True).encode("utf-8"))
+
+    tree_hashes: Dict[str, str] = {}
+    hashes = {}
+    for bin in bins:
+        owners = [
+            p["id"] for p in packages.values() if any(t["name"] == bin and "bin" in t["kind"] for t in p["targets"])
+        ]
+        if len(owners) != 1:
+            logging.warning(f"can't find the package of {bin}, it won't be cached")
+            continue
+
+        closure = set()
+        todo = owners
+        while todo:
+            package_id = todo.pop()
+            if package_id not in closure:
+                closure.add(package_id)
+                todo.extend(dependencies.get(package_id, []))
+
+        h = common.copy()
+        h.update(bin.encode("utf-8"))
+        for package_id in sorted(closure):
+            package = packages[package_id]
+            if package["source"] is None:
+                package_dir = path.dirname(package["manifest_path"])
+                if package_dir not in tree_hashes:
+                    tree_hashes[package_dir] = _hash_tree(package_dir)
+                h.update(f"{package['name']} {package['version']} {tree_hashes[package_dir]}".encode("utf-8"))
+        hashes[bin] = h.hexdigest()
+    return hashes
+
+
+def _restore_from_cache(key: str, dst_filename: str) -> bool:
+    cached = f"{cache_dir}/{key}.wasm.gz"
+    if not path.exists(cached):
+        return False
+    logging.info(f"Using cached {cached} for {dst_filename}")
+    with gzip.open(cached, "rb") as src, open(dst_filename, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return True
+
+
+def _store_in_cache(key: str, src_filename: str):
+    mkdir_p(cache_dir)
+    cached = f"{cache_dir}/{key}.wasm.gz"
+    # Write to a temporary file first, so concurrent jobs never see a partially written entry.
+    tmp = f"{cached}.{os.getpid()}.tmp"
+    with open(src_filename, "rb") as src, gzip.GzipFile(tmp, "wb", mtime=0) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, cached)
+
+
+def _target_wasm(bin, target_dir=ENV.cargo_target_dir):
+    return f"{target_dir}/wasm32-unknown-unknown/release/{bin}.wasm"
+
+
+def _link_or_copy(src_filename, dst_filename):
+    """Hard link `src_filename` to `dst_filename`, so the data isn't copied, unless they are on different file systems."""
+    try:
+        os.unlink(dst_filename)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src_filename, dst_filename)
+    except OSError:
+        shutil.copyfile(src_filename, dst_filename)
+
+
+def _optimize_wasm(src_filename, dst_filename):
+    try:
+        if skip_optimize:
+            _link_or_copy(src_filename, dst_filename)
+        else:
+            sh("ic-cdk-optimizer", "-o", dst_filename, src_filename)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        # Only look for the cause once something went wrong.
+        if not path.exists(src_filename):
+            raise Exception(f"ERROR: target canister Wasm binary does not exist: {src_filename}") from e
+        raise
+
+
+def _side_target_dir(name: str) -> str:
+    """
+    Cargo target directory for a build running concurrently with the main one, so they don't wait on each other's
+    target dir lock.
+
+    The name is stable rather than per run, so later runs reuse the build output (sccache doesn't cover proc-macros,
+    build scripts or linking) and no directories pile up. Jobs running the same build at the same time are serialized
+    by cargo's lock on it, just like on the main target dir.
+    """
+    return f"{ENV.cargo_target_dir}/side/{name}"
+
+
+def _sha256_file(filename) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        # mmap can't map empty files, and there's nothing to hash in them anyway.
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                h.update(data)
+    return h.hexdigest()
+
+
+def _advise_sequential(filename):
+    """Tell the kernel that `filename` will soon be read front to back, so it can start reading ahead."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        # The advice values are not flags, so they have to be given one at a time.
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
 
 
 def _build_with_features(bin_name, features, target_bin_name: Optional[str] = None):
@@ -68,17 +240,78 @@ def _build_with_features(bin_name, features, target_bin_name: Optional[str] = No
         "--features",
         features,
     )
-    os.rename(
-        f"{ENV.cargo_target_dir}/wasm32-unknown-unknown/release/{bin_name}.wasm",
-        f"{ENV.cargo_target_dir}/wasm32-unknown-unknown/release/{target_bin_name}.wasm",
+    os.rename(_target_wasm(bin_name), _target_wasm(target_bin_name))
+
+
+def _build_and_optimize(bins, artifacts_dir, pool, skip=frozenset()) -> List[AsyncResult]:
+    """
+    Build the given canisters and queue each of them in `pool` for optimization as soon as cargo reports its Wasm.
+
+    The canisters in `skip` are built, but not optimized, e.g. because their optimized Wasm came from the cache. Must be
+    run in `rs`.
+    """
+    proc = sh_async(
+        "cargo",
+        "build",
+        "--target",
+        "wasm32-unknown-unknown",
+        "--release",
+        "--message-format=json-render-diagnostics",
+        *itertools.chain.from_iterable(("--bin", b) for b in bins),
+        stdout=subprocess.PIPE,
+        text=True,
     )
+    pending = []
+    remaining = set(bins) - set(skip)
+    assert proc.stdout is not None
+    for line in proc.stdout:
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            print(line, end="")
+            continue
+        if message.get("reason") != "compiler-artifact" or "bin" not in message["target"]["kind"]:
+            continue
+        bin = message["target"]["name"]
+        for filename in message["filenames"]:
+            if bin in remaining and filename.endswith(".wasm"):
+                remaining.remove(bin)
+                pending.append(pool.apply_async(_optimize_wasm, (filename, f"{artifacts_dir}/{bin}.wasm")))
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    # Look for anything cargo didn't report at the usual place, so a missing Wasm fails as usual.
+    pending.extend(
+        pool.apply_async(_optimize_wasm, (_target_wasm(b), f"{artifacts_dir}/{b}.wasm")) for b in sorted(remaining)
+    )
+    return pending
 
 
 def run(artifacts_dir=default_artifacts_dir):
     mkdir_p(artifacts_dir)
 
+    # Incremental compilation state makes sccache miss, and it buys nothing for a one-off release build.
+    environ["CARGO_INCREMENTAL"] = "0"
+    environ["CARGO_PROFILE_RELEASE_INCREMENTAL"] = "false"
+    if "RUSTC_WRAPPER" not in environ and shutil.which("sccache") is not None:
+        environ["RUSTC_WRAPPER"] = "sccache"
+    wrapper = environ.get("RUSTC_WRAPPER")
+    if wrapper is not None and path.basename(wrapper) == "sccache":
+        # Start the server once up front, so the concurrent cargo invocations all connect to the same warm server
+        # instead of racing to start one. It's left running for show_sccache_stats and later jobs.
+        try:
+            sh(wrapper, "--start-server")
+        except subprocess.CalledProcessError as e:
+            # Starting fails as well when a server is running already, which is only fine if it answers.
+            if subprocess.run([wrapper, "--show-stats"], stdout=subprocess.DEVNULL).returncode != 0:
+                raise Exception("ERROR: can't start the sccache server, check the SCCACHE_* settings") from e
+            logging.info("sccache server is already running")
+
     # TODO: get rid of this usage of git revision
+    # openssl-sign.sh records this as the revision of the signed artifacts.
     environ["VERSION"] = ENV.build_id
+    # Keep timestamps out of anything the toolchain or build scripts produce.
+    environ["SOURCE_DATE_EPOCH"] = "0"
 
     # Make sure git-related non-determinism does't get through.
     if ENV.is_gitlab:
@@ -95,43 +328,98 @@ def run(artifacts_dir=default_artifacts_dir):
             f"Non-determinism detection commit at {date}",
         )
 
-    with cwd("rs"):
-        _build_with_features("ledger-canister", "notify-method")
-        _build_with_features("governance-canister", "test")
+    hashes: Dict[str, str] = {}
+    cached: Set[str] = set()
+    if cache_dir is not None:
+        with cwd("rs"):
+            hashes = _canister_hashes(CANISTERS)
+        cached = {b for b, h in hashes.items() if _restore_from_cache(h, f"{artifacts_dir}/{b}.wasm")}
 
-        sh("cargo", "build", "--target", "wasm32-unknown-unknown", "--release", "--bin", "ledger-archive-node-canister")
-        _optimize_wasm(artifacts_dir, "ledger-archive-node-canister")
+    # Every optimizer run reads and writes its own file, so they can all run at once, even while cargo is still
+    # building the other canisters. Leaving the pool terminates the workers, also if the build fails.
+    with multiprocessing.Pool() as p:
+        with cwd("rs"):
+            # The feature builds compile the same packages as the main build, whose build scripts write into `gen/`
+            # in the source tree, so they run one after another.
+            pending = []
+            for b, features in FEATURE_BUILDS:
+                _build_with_features(b, features)
+                pending.append(
+                    p.apply_async(
+                        _optimize_wasm, (_target_wasm(f"{b}_{features}"), f"{artifacts_dir}/{b}_{features}.wasm")
+                    )
+                )
 
-        sh(
-            "cargo",
-            "build",
-            "--target",
-            "wasm32-unknown-unknown",
-            "--release",
-            *flatten([["--bin", b] for b in CANISTERS]),
-        )
+            # The lifeline is compiled by moc and only shares build dependencies with the canisters. Their `gen/`
+            # output is in place after the feature builds, and prost-build leaves unchanged files alone, so the
+            # lifeline can be built alongside the main build, in its own target dir.
+            lifeline = sh_async(
+                "cargo",
+                "build",
+                "--target",
+                "wasm32-unknown-unknown",
+                cwd=f"{ENV.top}/rs/nns/handlers/lifeline",
+                env={**environ, "CARGO_TARGET_DIR": _side_target_dir("lifeline")},
+            )
 
-    with cwd("rs/nns/handlers/lifeline"):
-        sh("cargo", "build", "--target", "wasm32-unknown-unknown")
-        sh("ic-cdk-optimizer", "-o", f"{artifacts_dir}/lifeline.wasm", "gen/lifeline.wasm")
+            try:
+                # The cached canisters are still built, as leaving them out would change the features cargo enables
+                # for the shared dependencies of the others. Only their optimization is skipped.
+                pending.extend(_build_and_optimize(CANISTERS, artifacts_dir, p, skip=cached))
+                if lifeline.wait() != 0:
+                    raise subprocess.CalledProcessError(lifeline.returncode, lifeline.args)
+            finally:
+                # Don't leave it behind writing into the source tree when the main build fails or is interrupted.
+                if lifeline.poll() is None:
+                    lifeline.kill()
+                    lifeline.wait()
 
-    logging.info("Building of Wasm canisters finished")
+        logging.info("Building of Wasm canisters finished")
 
-    for canister in ["ledger-canister_notify-method", "governance-canister_test"] + CANISTERS:
-        _optimize_wasm(artifacts_dir, canister)
+        to_optimize = [(f"{ENV.top}/rs/nns/handlers/lifeline/gen/lifeline.wasm", f"{artifacts_dir}/lifeline.wasm")]
 
-    for can, filepath in CANISTER_COPY_LIST.items():
-        src_filename = f"{filepath}/{can}"
-        if can.endswith(".wasm"):
-            sh("ic-cdk-optimizer", "-o", f"{artifacts_dir}/{can}", f"{ENV.top}/{src_filename}")
-        elif can.endswith(".wat"):
-            shutil.copyfile(f"{ENV.top}/{src_filename}", f"{artifacts_dir}/{can}")
-        else:
-            logging.error(f"unknown (not .wat or .wasm) canister type: {src_filename}")
-            exit(1)
+        for can, filepath in CANISTER_COPY_LIST:
+            src_filename = f"{filepath}/{can}"
+            if can.endswith(".wasm"):
+                to_optimize.append((f"{ENV.top}/{src_filename}", f"{artifacts_dir}/{can}"))
+            elif can.endswith(".wat"):
+                _link_or_copy(f"{ENV.top}/{src_filename}", f"{artifacts_dir}/{can}")
+            else:
+                logging.error(f"unknown (not .wat or .wasm) canister type: {src_filename}")
+                exit(1)
 
-    sh(f"sha256sum {artifacts_dir}/*", shell=True)
-    sh(f"pigz -f --no-name {artifacts_dir}/*", shell=True)
+        pending.extend(p.apply_async(_optimize_wasm, args) for args in to_optimize)
+        for result in pending:
+            result.get()
+
+    for canister in CANISTERS:
+        if canister in hashes and canister not in cached:
+            _store_in_cache(hashes[canister], f"{artifacts_dir}/{canister}.wasm")
+
+    artifacts = sorted(glob(f"{artifacts_dir}/*"))
+    for filename in artifacts:
+        _advise_sequential(filename)
+
+    # Same output as sha256sum, without the extra process. hashlib uses the SHA extensions of the CPU where available.
+    for filename in artifacts:
+        print(f"{_sha256_file(filename)}  {filename}")
+    # One single-threaded pigz per file and one per core, so the many small canisters are compressed in parallel
+    # as well, without oversubscribing the cores.
+    sh(
+        "xargs",
+        "-0",
+        "-r",
+        "-n",
+        "1",
+        "-P",
+        str(os.cpu_count()),
+        "pigz",
+        "-p",
+        "1",
+        "-f",
+        "--no-name",
+        input=b"\0".join(filename.encode("utf-8") for filename in artifacts),
+    )
 
     if ENV.is_gitlab:
         sh("gitlab-ci/src/artifacts/openssl-sign.sh", f"{ENV.top}/artifacts/canisters{artifact_ext}")
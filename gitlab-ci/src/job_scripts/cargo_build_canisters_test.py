@@ -0,0 +1,224 @@
+"""Tests for the helpers of cargo_build_canisters."""
+import json
+import os
+import subprocess
+
+import pytest
+from git import Repo
+
+import cargo_build_canisters
+
+
+def setup_repo(tmpdir):
+    """Set up a git repo with a committed crate and a gitignored `gen/` directory."""
+    repo = Repo.init(tmpdir, bare=False)
+    repo.config_writer().set_value("user", "name", "myusername").release()
+    repo.config_writer().set_value("user", "email", "myemail").release()
+
+    os.makedirs(f"{tmpdir}/src")
+    os.makedirs(f"{tmpdir}/gen")
+    with open(f"{tmpdir}/Cargo.toml", "w") as f:
+        f.write('[package]\nname = "foo"\n')
+    with open(f"{tmpdir}/src/main.rs", "w") as f:
+        f.write("fn main() {}\n")
+    with open(f"{tmpdir}/gen/.gitignore", "w") as f:
+        f.write("*\n!.gitignore\n")
+
+    git = repo.git
+    git.add("-A")
+    git.commit("-m initial commit")
+    return repo
+
+
+def test_hash_tree_is_stable(tmpdir):
+    """Test that the same sources give the same hash, also in another checkout."""
+    setup_repo(f"{tmpdir}/a")
+    Repo.clone_from(f"{tmpdir}/a", f"{tmpdir}/b")
+
+    assert cargo_build_canisters._hash_tree(f"{tmpdir}/a") == cargo_build_canisters._hash_tree(f"{tmpdir}/a")
+    assert cargo_build_canisters._hash_tree(f"{tmpdir}/a") == cargo_build_canisters._hash_tree(f"{tmpdir}/b")
+
+
+def test_hash_tree_ignores_untracked_files(tmpdir):
+    """Test that build script output in ignored directories and other untracked files don't change the hash."""
+    setup_repo(tmpdir)
+    before = cargo_build_canisters._hash_tree(tmpdir)
+
+    with open(f"{tmpdir}/gen/foo.pb.v1.rs", "w") as f:
+        f.write("// generated\n")
+    with open(f"{tmpdir}/notes.txt", "w") as f:
+        f.write("not added\n")
+
+    assert cargo_build_canisters._hash_tree(tmpdir) == before
+
+
+def test_hash_tree_covers_uncommitted_changes(tmpdir):
+    """Test that modified and deleted tracked files change the hash."""
+    setup_repo(tmpdir)
+    before = cargo_build_canisters._hash_tree(tmpdir)
+
+    with open(f"{tmpdir}/src/main.rs", "w") as f:
+        f.write("fn main() { panic!() }\n")
+    modified = cargo_build_canisters._hash_tree(tmpdir)
+    assert modified != before
+
+    os.remove(f"{tmpdir}/src/main.rs")
+    assert cargo_build_canisters._hash_tree(tmpdir) not in [before, modified]
+
+
+def test_hash_tree_fails_outside_git(tmpdir, monkeypatch):
+    """Test that sources git can't list raise instead of hashing like an empty tree."""
+    # Don't let git find a repo further up.
+    monkeypatch.setenv("GIT_CEILING_DIRECTORIES", str(tmpdir.dirpath()))
+    os.makedirs(f"{tmpdir}/src")
+    with open(f"{tmpdir}/src/main.rs", "w") as f:
+        f.write("fn main() {}\n")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        cargo_build_canisters._hash_tree(tmpdir)
+
+
+def test_cache_round_trip(tmpdir, monkeypatch):
+    """Test that a stored canister is restored byte for byte, and that a missing entry is reported as such."""
+    monkeypatch.setattr(cargo_build_canisters, "cache_dir", f"{tmpdir}/cache")
+    with open(f"{tmpdir}/in.wasm", "wb") as f:
+        f.write(b"\0asm\1\0\0\0" * 1000)
+
+    assert not cargo_build_canisters._restore_from_cache("abc", f"{tmpdir}/out.wasm")
+    assert not os.path.exists(f"{tmpdir}/out.wasm")
+
+    cargo_build_canisters._store_in_cache("abc", f"{tmpdir}/in.wasm")
+    assert os.listdir(f"{tmpdir}/cache") == ["abc.wasm.gz"]
+
+    assert cargo_build_canisters._restore_from_cache("abc", f"{tmpdir}/out.wasm")
+    with open(f"{tmpdir}/in.wasm", "rb") as src, open(f"{tmpdir}/out.wasm", "rb") as dst:
+        assert src.read() == dst.read()
+
+
+def test_cache_entries_are_reproducible(tmpdir, monkeypatch):
+    """Test that storing the same canister twice gives identical cache entries."""
+    monkeypatch.setattr(cargo_build_canisters, "cache_dir", f"{tmpdir}/cache")
+    with open(f"{tmpdir}/in.wasm", "wb") as f:
+        f.write(b"\0asm\1\0\0\0")
+
+    cargo_build_canisters._store_in_cache("abc", f"{tmpdir}/in.wasm")
+    with open(f"{tmpdir}/cache/abc.wasm.gz", "rb") as f:
+        first = f.read()
+    cargo_build_canisters._store_in_cache("abc", f"{tmpdir}/in.wasm")
+    with open(f"{tmpdir}/cache/abc.wasm.gz", "rb") as f:
+        assert f.read() == first
+
+
+def test_link_or_copy_links(tmpdir):
+    """Test that the destination is replaced by a hard link to the source."""
+    with open(f"{tmpdir}/src.wat", "w") as f:
+        f.write("(module)")
+    with open(f"{tmpdir}/dst.wat", "w") as f:
+        f.write("old")
+
+    cargo_build_canisters._link_or_copy(f"{tmpdir}/src.wat", f"{tmpdir}/dst.wat")
+
+    assert os.path.samefile(f"{tmpdir}/src.wat", f"{tmpdir}/dst.wat")
+
+
+def test_link_or_copy_falls_back_to_copy(tmpdir, monkeypatch):
+    """Test that the source is copied when it can't be linked, e.g. across file systems."""
+
+    def fail_link(src, dst):
+        raise OSError("Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", fail_link)
+    with open(f"{tmpdir}/src.wat", "w") as f:
+        f.write("(module)")
+
+    cargo_build_canisters._link_or_copy(f"{tmpdir}/src.wat", f"{tmpdir}/dst.wat")
+
+    assert not os.path.samefile(f"{tmpdir}/src.wat", f"{tmpdir}/dst.wat")
+    with open(f"{tmpdir}/dst.wat") as f:
+        assert f.read() == "(module)"
+
+
+class RecordingPool:
+    """Stands in for a `multiprocessing.Pool`, recording the queued jobs instead of running them."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, func, args):
+        self.jobs.append((func, args))
+
+
+def fake_command(tmpdir, monkeypatch, name, script):
+    """Put an executable `name` running the given shell `script` first on the `PATH`."""
+    os.makedirs(f"{tmpdir}/bin", exist_ok=True)
+    with open(f"{tmpdir}/bin/{name}", "w") as f:
+        f.write(f"#!/bin/sh\n{script}\n")
+    os.chmod(f"{tmpdir}/bin/{name}", 0o755)
+    monkeypatch.setenv("PATH", f"{tmpdir}/bin:{os.environ['PATH']}")
+
+
+def cargo_message(reason, name, kind, filenames):
+    """Format a message like `cargo build --message-format=json` does, with just the fields that are looked at."""
+    return json.dumps({"reason": reason, "target": {"name": name, "kind": kind}, "filenames": filenames})
+
+
+def fake_cargo(tmpdir, monkeypatch, exit_code=0):
+    """Put a `cargo` on the `PATH` which reports a library and the binaries `a` and `b`, among other output."""
+    messages = [
+        "Compiling foo v0.1.0",
+        cargo_message("compiler-artifact", "foo", ["lib"], ["/t/libfoo.rlib"]),
+        cargo_message("compiler-artifact", "a", ["bin"], ["/t/a.d", "/t/a.wasm"]),
+        cargo_message("build-script-executed", "b", ["custom-build"], []),
+        cargo_message("compiler-artifact", "b", ["bin"], ["/t/b.wasm"]),
+        cargo_message("build-finished", "", [], []),
+    ]
+    with open(f"{tmpdir}/messages", "w") as f:
+        f.write("\n".join(messages) + "\n")
+    fake_command(tmpdir, monkeypatch, "cargo", f"cat {tmpdir}/messages\nexit {exit_code}")
+
+
+def test_build_and_optimize_queues_reported_wasm(tmpdir, monkeypatch):
+    """Test that the Wasm of each binary reported by cargo is queued, and the others are looked for at the usual place."""
+    fake_cargo(tmpdir, monkeypatch)
+    pool = RecordingPool()
+
+    cargo_build_canisters._build_and_optimize(["a", "b", "c", "d"], "/artifacts", pool, skip={"d"})
+
+    optimize = cargo_build_canisters._optimize_wasm
+    assert pool.jobs == [
+        (optimize, ("/t/a.wasm", "/artifacts/a.wasm")),
+        (optimize, ("/t/b.wasm", "/artifacts/b.wasm")),
+        (optimize, (cargo_build_canisters._target_wasm("c"), "/artifacts/c.wasm")),
+    ]
+
+
+def test_build_and_optimize_fails_with_cargo(tmpdir, monkeypatch):
+    """Test that a failing cargo raises, without looking for the missing Wasm."""
+    fake_cargo(tmpdir, monkeypatch, exit_code=101)
+    pool = RecordingPool()
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        cargo_build_canisters._build_and_optimize(["a", "b", "c"], "/artifacts", pool)
+
+    assert e.value.returncode == 101
+    assert [args[0] for func, args in pool.jobs] == ["/t/a.wasm", "/t/b.wasm"]
+
+
+def test_optimize_wasm_reports_missing_source(tmpdir, monkeypatch):
+    """Test that a failing optimizer is blamed on a missing source, if it is missing."""
+    fake_command(tmpdir, monkeypatch, "ic-cdk-optimizer", "exit 1")
+
+    with pytest.raises(Exception, match="does not exist"):
+        cargo_build_canisters._optimize_wasm(f"{tmpdir}/missing.wasm", f"{tmpdir}/out.wasm")
+
+
+def test_optimize_wasm_reraises_other_failures(tmpdir, monkeypatch):
+    """Test that the optimizer failing on an existing source is raised unchanged."""
+    fake_command(tmpdir, monkeypatch, "ic-cdk-optimizer", "exit 3")
+    with open(f"{tmpdir}/in.wasm", "wb") as f:
+        f.write(b"\0asm\1\0\0\0")
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        cargo_build_canisters._optimize_wasm(f"{tmpdir}/in.wasm", f"{tmpdir}/out.wasm")
+
+    assert e.value.returncode == 3
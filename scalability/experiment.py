@@ -472,8 +472,9 @@ class Experiment:
         """
         Write the current summary file.
 
-        The idea is that we write one after each iteration, so that we can
-        generate reports from intermediate versions.
+        Experiments either write one after each iteration, so that we can
+        generate reports from intermediate versions, or only once at the end,
+        recording each iteration with `append_summary_record` instead.
         """
         d = self.build_summary_file()
         d.update(
@@ -497,6 +498,24 @@ class Experiment:
         with open(os.path.join(self.out_dir, "experiment.json"), "w") as iter_file:
             iter_file.write(json.dumps(d))
 
+    def append_summary_record(self, iteration, load_total, failure_rate, t_median, num_succ):
+        """
+        Append the results of one iteration to the summary records.
+
+        Each call adds a single JSON line to summary.ndjson, so progress can be followed
+        without rewriting the full summary file after every iteration.
+        """
+        record = {
+            "iteration": iteration,
+            "load_total": load_total,
+            "failure_rate": failure_rate,
+            "t_median": t_median,
+            "num_succ": num_succ,
+            "t": int(time.time()),
+        }
+        with open(os.path.join(self.out_dir, "summary.ndjson"), "a") as records_file:
+            records_file.write(json.dumps(record) + "\n")
+
     def get_iter_logs_from_targets(self, machines: List[str], since_time: str, outdir: str):
         """Fetch logs from target machines since the given time."""
         ssh.run_all_ssh_in_parallel(
@@ -42,6 +42,14 @@ gflags.DEFINE_integer(
 gflags.DEFINE_float("stop_failure_rate", 0.95, "Maximum failure rate before aborting the benchmark.")
 gflags.DEFINE_integer("stop_t_median", 25000, "Maximum median latency before aborting the benchmark.")
 
+# Higher load is unlikely to increase the maximum capacity once it hasn't
+# increased for a couple of rounds and requests are failing already.
+gflags.DEFINE_integer(
+    "stop_rounds_without_improvement",
+    3,
+    "Number of rounds without a new rps_max, with failure rate above allowable_failure_rate, before aborting the benchmark.",
+)
+
 if __name__ == "__main__":
     experiment.parse_command_line_args()
     experiment_name = os.path.basename(__file__).replace(".py", "")
@@ -56,6 +64,7 @@ if __name__ == "__main__":
 
     rps_max = 0
     rps_max_in = None
+    rounds_since_rps_max_increase = 0
 
     num_succ_per_iteration = []
 
@@ -71,38 +80,62 @@ if __name__ == "__main__":
     )
     print(datapoints)
 
-    while run:
-
-        load_total = datapoints[iteration]
-        iteration += 1
-
-        rps.append(load_total)
-        print(f"🚀 Testing with load: {load_total} and updates={exp.use_updates}")
-
-        evaluated_summaries = exp.run_experiment(
-            {
-                "load_total": load_total,
-                "payload_size": FLAGS.payload_size,
-                "duration": FLAGS.iter_duration,
-            }
-        )
-        failure_rate, t_median_list, _, _, _, _, _, num_succ, _ = evaluated_summaries.convert_tuple()
-
-        t_median = max(t_median_list)
-        num_succ_per_iteration.append(num_succ)
-
-        print(f"🚀  ... failure rate for {load_total} rps was {failure_rate} median latency is {t_median}")
-
-        if failure_rate < FLAGS.allowable_failure_rate and t_median < FLAGS.allowable_t_median:
-            if num_succ / exp.last_duration > rps_max:
-                rps_max = num_succ / exp.last_duration
-                rps_max_in = load_total
-
-        run = failure_rate < FLAGS.stop_failure_rate and t_median < FLAGS.stop_t_median and iteration < len(datapoints)
-
-        # Write summary file in each iteration including experiment specific data.
-        rtype = "update" if exp.use_updates else "query"
-        state = "running" if run else "done"
+    # Flags don't change while the benchmark is running.
+    allowable_failure_rate = FLAGS.allowable_failure_rate
+    allowable_t_median = FLAGS.allowable_t_median
+    stop_failure_rate = FLAGS.stop_failure_rate
+    stop_t_median = FLAGS.stop_t_median
+    stop_rounds_without_improvement = FLAGS.stop_rounds_without_improvement
+    iter_duration = FLAGS.iter_duration
+    payload_size = FLAGS.payload_size
+
+    # Record each iteration, but write the full summary file including experiment specific data only once at the
+    # end. This also happens if an iteration fails, so that a report can still be generated.
+    try:
+        while run:
+
+            load_total = datapoints[iteration]
+            iteration += 1
+
+            rps.append(load_total)
+            print(f"🚀 Testing with load: {load_total} and updates={exp.use_updates}")
+
+            evaluated_summaries = exp.run_experiment(
+                {
+                    "load_total": load_total,
+                    "payload_size": payload_size,
+                    "duration": iter_duration,
+                }
+            )
+            failure_rate, t_median_list, _, _, _, _, _, num_succ, _ = evaluated_summaries.convert_tuple()
+
+            t_median = max(t_median_list)
+            num_succ_per_iteration.append(num_succ)
+
+            print(f"🚀  ... failure rate for {load_total} rps was {failure_rate} median latency is {t_median}")
+
+            rounds_since_rps_max_increase += 1
+            if failure_rate < allowable_failure_rate and t_median < allowable_t_median:
+                if num_succ / exp.last_duration > rps_max:
+                    rps_max = num_succ / exp.last_duration
+                    rps_max_in = load_total
+                    rounds_since_rps_max_increase = 0
+
+            saturated = (
+                rounds_since_rps_max_increase >= stop_rounds_without_improvement
+                and failure_rate > allowable_failure_rate
+            )
+            run = (
+                failure_rate < stop_failure_rate
+                and t_median < stop_t_median
+                and iteration < len(datapoints)
+                and not saturated
+            )
+
+            exp.append_summary_record(iteration, load_total, failure_rate, t_median, num_succ)
+
+            print(f"🚀  ... maximum capacity so far is {rps_max}")
+    finally:
         exp.write_summary_file(
             "run_large_memory_experiment",
             {
@@ -113,12 +146,10 @@ if __name__ == "__main__":
             },
             rps,
             "requests / s",
-            rtype=rtype,
-            state=state,
+            rtype="update" if exp.use_updates else "query",
+            state="running" if run else "done",
         )
 
-        print(f"🚀  ... maximum capacity so far is {rps_max}")
-
     ElasticSearch.send_max_capacity(
         experiment_name,
         "Update" if FLAGS.use_updates else "Query",